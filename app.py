@@ -1,19 +1,91 @@
 # -*- coding: utf-8 -*-
 import csv
+import fcntl
+import hashlib
 import io
-import os
 import json
+import math
+import mmap
+import os
+import queue
 import re
+import threading
 import time
 import uuid
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date
-from typing import List, Dict, Optional, Any
+from functools import lru_cache
+from urllib.parse import urlencode
+from typing import List, Dict, Optional, Any, BinaryIO, TextIO
 
+import orjson
+import phonenumbers
 import requests
-from flask import Flask, jsonify, render_template, request
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from flask import Flask, Response, jsonify, render_template, request, stream_with_context
+from flask.json.provider import DefaultJSONProvider
+
+
+# orjson reads integers beyond 64 bits as floats and refuses to write them; the stdlib keeps them exact.
+# It also rejects NaN / Infinity on input and writes them as null. Such values are rare in leads,
+# so only those documents take the slower stdlib path.
+_LONG_NUMBER_RE = re.compile(r"\d{20,}")
+_LONG_NUMBER_RE_BYTES = re.compile(rb"\d{20,}")
+
+
+def json_loads(data: str | bytes) -> Any:
+    pattern = _LONG_NUMBER_RE if isinstance(data, str) else _LONG_NUMBER_RE_BYTES
+    if pattern.search(data):
+        return json.loads(data)
+    try:
+        return orjson.loads(data)
+    except orjson.JSONDecodeError:
+        return json.loads(data)
+
+
+def _has_nonfinite(obj: Any) -> bool:
+    if isinstance(obj, float):
+        return not math.isfinite(obj)
+    if isinstance(obj, dict):
+        return any(_has_nonfinite(v) for v in obj.values())
+    if isinstance(obj, (list, tuple)):
+        return any(_has_nonfinite(v) for v in obj)
+    return False
+
+
+def json_dumps(obj: Any, default: Any = None, option: int = 0) -> bytes:
+    try:
+        out = orjson.dumps(obj, default=default, option=option)
+    except TypeError:
+        out = None
+    # only output containing null can hide a NaN, so the walk is skipped for almost every lead
+    if out is not None and not (b"null" in out and _has_nonfinite(obj)):
+        return out
+    return json.dumps(
+        obj,
+        default=default,
+        ensure_ascii=False,
+        separators=(",", ":"),
+        sort_keys=bool(option & orjson.OPT_SORT_KEYS),
+    ).encode("utf-8")
+
+
+class OrjsonProvider(DefaultJSONProvider):
+    def dumps(self, obj: Any, **kwargs: Any) -> str:
+        option = orjson.OPT_NON_STR_KEYS
+        if self.sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        return json_dumps(obj, default=self.default, option=option).decode("utf-8")
+
+    def loads(self, s: str | bytes, **kwargs: Any) -> Any:
+        return json_loads(s)
+
 
 app = Flask(__name__)
-app.config["JSON_AS_ASCII"] = False  # С‡С‚РѕР±С‹ JSON РѕС‚РґР°РІР°Р» СЂСѓСЃСЃРєРёРµ Р±СѓРєРІС‹ РЅРѕСЂРјР°Р»СЊРЅРѕ
+app.json = OrjsonProvider(app)
+app.config["START_SHEET_POLLER"] = os.environ.get("START_SHEET_POLLER") == "1"
 
 # --- РќРђРЎРўР РћР™РљР GOOGLE SHEETS ---
 
@@ -24,20 +96,47 @@ CSV_URL = f"https://docs.google.com/spreadsheets/d/{SHEET_ID}/export?format=csv&
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 STATE_FILE = os.path.join(BASE_DIR, "last_row_google_sheet.txt")
-HISTORY_FILE = os.path.join(BASE_DIR, "leads_history.json")
+SENT_HASHES_FILE = os.path.join(BASE_DIR, "sent_lead_ids.txt")
+HISTORY_FILE = os.path.join(BASE_DIR, "leads_history.jsonl")
+LEGACY_HISTORY_FILE = os.path.join(BASE_DIR, "leads_history.json")
 ASSIGNED_CONFIG_FILE = os.path.join(BASE_DIR, "assigned_config.json")
+POLLER_LOCK_FILE = os.path.join(BASE_DIR, "sheet_poller.lock")
 
 REFRESH_INTERVAL_SECONDS = 30
+# An open page polls /api/leads/new every few seconds and loads older leads from /api/leads,
+# so buffered leads are only worth keeping briefly, and never without bound.
+NEW_LEADS_TTL_SECONDS = 2 * REFRESH_INTERVAL_SECONDS
+NEW_LEADS_BUFFER_MAX = 500
+# (connect, read) for the CSV export: the poller thread must never hang on a stalled Google connection.
+SHEET_REQUEST_TIMEOUT = (5, 30)
 
 # --- РќРђРЎРўР РћР™РљР BITRIX24 ---
 
 BITRIX24_WEBHOOK_BASE = "https://nobilauto.bitrix24.ru/rest/18397/h5c7kw97sfp3uote"
-BITRIX24_LEAD_ADD_URL = f"{BITRIX24_WEBHOOK_BASE}/crm.lead.add"
-BITRIX24_CONTACT_ADD_URL = f"{BITRIX24_WEBHOOK_BASE}/crm.contact.add"
+BITRIX24_BATCH_URL = f"{BITRIX24_WEBHOOK_BASE}/batch"
 BITRIX24_USER_GET_URL = f"{BITRIX24_WEBHOOK_BASE}/user.get"
 
 BITRIX_SOURCE_ID = "UC_Y3Q75D"
 
+# Region used to parse phone numbers written without a country code.
+PHONE_DEFAULT_REGION = "MD"
+
+# Bitrix calls are network-bound: new rows are sent concurrently, one batch call (contact + lead) per row.
+BITRIX_MAX_WORKERS = 20
+_bitrix_executor = ThreadPoolExecutor(max_workers=BITRIX_MAX_WORKERS, thread_name_prefix="bitrix")
+
+# One keep-alive pool for Google Sheets and Bitrix24 instead of a new TLS handshake per call.
+# Retry only covers idempotent methods by default, so lead/contact POSTs are never duplicated.
+_session = requests.Session()
+_session.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=10,
+        pool_maxsize=BITRIX_MAX_WORKERS,
+        max_retries=Retry(total=2, backoff_factor=0.2, status_forcelist=[429, 502, 503, 504]),
+    ),
+)
+
 # Р РѕС‚Р°С†РёСЏ РјРµР¶РґСѓ РѕС‚РІРµС‚СЃС‚РІРµРЅРЅС‹РјРё + РґРЅРµРІРЅС‹Рµ Р»РёРјРёС‚С‹
 ASSIGNED_IDS = [21392, 24518, 14804]
 ASSIGNED_INDEX = 0
@@ -55,6 +154,28 @@ LAST_BITRIX_DEBUG: Dict = {}
 
 _cached_rows: List[Dict] = []
 _last_fetch_ts: float = 0.0
+_last_etag: str = ""
+_last_modified: str = ""
+_history_cache: Optional[List[Dict]] = None
+_last_row_idx: Optional[int] = None
+_history_fh: Optional[BinaryIO] = None
+_sent_hashes: Optional["Counter[str]"] = None
+_sent_fh: Optional[TextIO] = None
+_sent_needs_seed = False
+_contact_hashes: set = set()  # contact identities seen in the sheet since start
+_repeated_id_rows = 0
+_state_queue: "queue.Queue[int]" = queue.Queue()
+_history_lock = threading.RLock()
+_new_leads_buffer: "deque[tuple]" = deque(maxlen=NEW_LEADS_BUFFER_MAX)  # (added_ts, lead)
+_new_leads_lock = threading.Lock()
+_poller_started = False
+_poll_wakeup = threading.Event()
+_first_poll_done = threading.Event()
+_poller_lock_fd: Optional[int] = None
+_poller_start_lock = threading.Lock()
+_poller_retry_at: float = 0.0
+_request_polling = False
+_rotation_lock = threading.Lock()
 ASSIGNEE_NAME_TTL_SECONDS = 120
 _assignee_name_cache: Dict[int, Dict[str, Any]] = {}
 DEFAULT_ASSIGNED_IDS = ASSIGNED_IDS.copy()
@@ -64,21 +185,41 @@ DEFAULT_ASSIGNEE_NAMES = ASSIGNEE_NAMES.copy()
 
 # ================== GOOGLE SHEETS ==================
 
-def load_sheet_rows() -> List[Dict]:
-    global _cached_rows, _last_fetch_ts
+def parse_sheet_csv(stream) -> List[Dict]:
+    # csv.reader plus one shared header tuple: avoids DictReader's per-row Python overhead.
+    reader = csv.reader(stream)
+    header = tuple(next(reader, ()))
+    return [dict(zip(header, values)) for values in reader if values]
+
+
+def load_sheet_rows(force: bool = False) -> List[Dict]:
+    global _cached_rows, _last_fetch_ts, _last_etag, _last_modified
 
     now = time.time()
 
-    if _cached_rows and (now - _last_fetch_ts) < REFRESH_INTERVAL_SECONDS:
+    if not force and _cached_rows and (now - _last_fetch_ts) < REFRESH_INTERVAL_SECONDS:
         return _cached_rows
 
-    resp = requests.get(CSV_URL)
-    resp.raise_for_status()
-    resp.encoding = "utf-8"
-    text = resp.text
+    headers = {}
+    if _cached_rows:
+        if _last_etag:
+            headers["If-None-Match"] = _last_etag
+        if _last_modified:
+            headers["If-Modified-Since"] = _last_modified
+
+    with _session.get(CSV_URL, headers=headers, stream=True, timeout=SHEET_REQUEST_TIMEOUT) as resp:
+        if resp.status_code == 304:
+            _last_fetch_ts = now
+            return _cached_rows
+        resp.raise_for_status()
 
-    reader = csv.DictReader(io.StringIO(text))
-    rows = list(reader)
+        # Parse straight from the socket instead of buffering the whole body as str.
+        resp.raw.decode_content = True
+        resp.raw.auto_close = False
+        rows = parse_sheet_csv(io.TextIOWrapper(resp.raw, encoding="utf-8", newline=""))
+
+        _last_etag = resp.headers.get("ETag", "")
+        _last_modified = resp.headers.get("Last-Modified", "")
 
     _cached_rows = rows
     _last_fetch_ts = now
@@ -86,34 +227,183 @@ def load_sheet_rows() -> List[Dict]:
     return rows
 
 
-def get_last_row_index() -> int:
-    if not os.path.exists(STATE_FILE):
+def get_sheet_rows() -> List[Dict]:
+    # Routes read whatever the poller fetched last; only a cold start goes to Google.
+    rows = _cached_rows
+    if rows:
+        return rows
+    return load_sheet_rows()
+
+
+def _read_last_row_index() -> int:
+    # Read once at startup (the value is cached in memory afterwards), creating the file if missing.
+    try:
+        fd = os.open(STATE_FILE, os.O_RDWR | os.O_CREAT, 0o644)
+    except OSError:
         return -1
     try:
-        with open(STATE_FILE, "r", encoding="utf-8") as f:
-            return int(f.read().strip())
+        return int(os.pread(fd, 32, 0).strip())
     except Exception:
         return -1
+    finally:
+        os.close(fd)
+
+
+def _state_writer_loop() -> None:
+    while True:
+        idx = _state_queue.get()
+        # only the newest value matters, skip the ones queued behind it
+        while True:
+            try:
+                idx = _state_queue.get_nowait()
+            except queue.Empty:
+                break
+        # tmp file + os.replace: a crash mid-write never leaves a corrupted watermark behind
+        tmp_path = STATE_FILE + ".tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.write(str(idx))
+            os.replace(tmp_path, STATE_FILE)
+        except Exception as e:
+            print(f"[WARN] Cannot write state file: {e}")
+
+
+def get_last_row_index() -> int:
+    global _last_row_idx
+    if _last_row_idx is None:
+        _last_row_idx = _read_last_row_index()
+    return _last_row_idx
 
 
 def set_last_row_index(idx: int) -> None:
-    with open(STATE_FILE, "w", encoding="utf-8") as f:
-        f.write(str(idx))
+    global _last_row_idx
+    if idx == get_last_row_index():
+        return
+    _last_row_idx = idx
+    _state_queue.put(idx)
 
 
-def load_history() -> List[Dict]:
+# Meta lead export columns that identify a lead on their own, in order of preference.
+LEAD_IDENTITY_COLUMNS = ("id", "lead_id", "created_time")
+
+
+def row_identity(row: Dict) -> List[str]:
+    # Only what identifies the lead: edited cells or new sheet columns must not make an old row look new.
+    for column in LEAD_IDENTITY_COLUMNS:
+        value = str(row.get(column) or "").strip()
+        if value:
+            return [column, value]
+    return [
+        "contact",
+        str(_first(row, _FIELD_ALIASES["full_name"])).strip().lower(),
+        _parse_phone(str(_first(row, _FIELD_ALIASES["phone"])))[0],
+        str(_first(row, _FIELD_ALIASES["email"])).strip().lower(),
+    ]
+
+
+def _hash_identity(identity: List[str]) -> str:
+    return hashlib.sha1(orjson.dumps(identity)).hexdigest()
+
+
+def load_sent_hashes() -> "Counter[str]":
+    # A lead id is sent at most once. The contact fallback is counted instead, as the number of
+    # rows with it still in the sheet, since the same person submitting the form twice is two leads.
+    global _sent_hashes, _sent_needs_seed
+    if _sent_hashes is None:
+        hashes: "Counter[str]" = Counter()
+        try:
+            with open(SENT_HASHES_FILE, "r", encoding="utf-8") as f:
+                hashes.update(line.strip() for line in f if line.strip())
+        except FileNotFoundError:
+            # decided once here: the first poll seeds the file from the row index watermark
+            _sent_needs_seed = True
+        _sent_hashes = hashes
+    return _sent_hashes
+
+
+def _get_sent_fh() -> TextIO:
+    global _sent_fh
+    if _sent_fh is None:
+        _sent_fh = open(SENT_HASHES_FILE, "a", encoding="utf-8")
+    return _sent_fh
+
+
+def mark_rows_sent(hashes: List[str]) -> None:
+    # One line per sent row, repeats included.
+    if not hashes:
+        return
+    f = _get_sent_fh()
+    f.writelines(h + "\n" for h in hashes)
+    f.flush()
+    load_sent_hashes().update(hashes)
+
+
+def _rewrite_sent_hashes() -> None:
+    # Only needed when sheet rows were deleted, so the file is rarely rewritten.
+    global _sent_fh
+    if _sent_fh is not None:
+        _sent_fh.close()
+        _sent_fh = None
+    tmp_path = SENT_HASHES_FILE + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.writelines(h + "\n" for h in load_sent_hashes().elements())
+    os.replace(tmp_path, SENT_HASHES_FILE)
+
+
+def _read_history_file() -> List[Dict]:
     if not os.path.exists(HISTORY_FILE):
-        return []
+        if not os.path.exists(LEGACY_HISTORY_FILE):
+            return []
+        try:
+            with open(LEGACY_HISTORY_FILE, "rb") as f:
+                legacy = json_loads(f.read())
+        except Exception:
+            return []
+        save_history(legacy)
+        return legacy
+
+    leads: List[Dict] = []
     try:
-        with open(HISTORY_FILE, "r", encoding="utf-8") as f:
-            return json.load(f)
+        with open(HISTORY_FILE, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return []
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                for line in iter(mm.readline, b""):
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        leads.append(json_loads(line))
+                    except ValueError:
+                        continue
     except Exception:
         return []
+    return leads
+
+
+def load_history() -> List[Dict]:
+    global _history_cache
+    if _history_cache is None:
+        _history_cache = _read_history_file()
+    return _history_cache
+
+
+def _get_history_fh() -> BinaryIO:
+    global _history_fh
+    if _history_fh is None:
+        _history_fh = open(HISTORY_FILE, "ab")
+    return _history_fh
 
 
 def save_history(leads: List[Dict]) -> None:
-    with open(HISTORY_FILE, "w", encoding="utf-8") as f:
-        json.dump(leads, f, ensure_ascii=False, indent=2)
+    global _history_cache, _history_fh
+    with _history_lock:
+        if _history_fh is not None:
+            _history_fh.close()
+            _history_fh = None
+        with open(HISTORY_FILE, "wb") as f:
+            f.writelines(json_dumps(row) + b"\n" for row in leads)
+        _history_cache = leads
 
 
 def append_to_history(new_leads: List[Dict]) -> List[Dict]:
@@ -124,31 +414,36 @@ def append_to_history(new_leads: List[Dict]) -> List[Dict]:
         row_copy = dict(row)
         row_copy["__id"] = row_copy.get("__id") or uuid.uuid4().hex
         prepared.append(row_copy)
-    history = load_history()
-    history.extend(prepared)
-    save_history(history)
+    with _history_lock:
+        history = load_history()
+        f = _get_history_fh()
+        f.writelines(json_dumps(row) + b"\n" for row in prepared)
+        f.flush()
+        history.extend(prepared)
     return prepared
 
 
 def load_history_with_ids() -> List[Dict]:
-    history = load_history()
-    changed = False
-    for row in history:
-        if "__id" not in row:
-            row["__id"] = uuid.uuid4().hex
-            changed = True
-    if changed:
-        save_history(history)
+    with _history_lock:
+        history = load_history()
+        changed = False
+        for row in history:
+            if "__id" not in row:
+                row["__id"] = uuid.uuid4().hex
+                changed = True
+        if changed:
+            save_history(history)
     return history
 
 
 def remove_lead_from_history(lead_id: str) -> bool:
-    history = load_history_with_ids()
-    for i, row in enumerate(history):
-        if row.get("__id") == lead_id:
-            history.pop(i)
-            save_history(history)
-            return True
+    with _history_lock:
+        history = load_history_with_ids()
+        for i, row in enumerate(history):
+            if row.get("__id") == lead_id:
+                history.pop(i)
+                save_history(history)
+                return True
     return False
 
 
@@ -191,8 +486,8 @@ def save_assigned_config() -> None:
         "assignee_names": serializable_names,
     }
     try:
-        with open(ASSIGNED_CONFIG_FILE, "w", encoding="utf-8") as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
+        with open(ASSIGNED_CONFIG_FILE, "wb") as f:
+            f.write(orjson.dumps(data, option=orjson.OPT_INDENT_2))
     except Exception as e:
         print(f"[WARN] Cannot write assigned config: {e}")
 
@@ -204,8 +499,8 @@ def load_assigned_config() -> None:
         return
 
     try:
-        with open(ASSIGNED_CONFIG_FILE, "r", encoding="utf-8") as f:
-            data = json.load(f)
+        with open(ASSIGNED_CONFIG_FILE, "rb") as f:
+            data = orjson.loads(f.read())
     except Exception:
         ensure_assigned_integrity()
         return
@@ -242,10 +537,13 @@ def load_assigned_config() -> None:
 
 
 def get_assignees_snapshot() -> List[Dict]:
-    _reset_daily_counters_if_new_day()
-    ensure_assigned_integrity()
+    with _rotation_lock:
+        _reset_daily_counters_if_new_day()
+        ensure_assigned_integrity()
+        assignee_ids = list(ASSIGNED_IDS)
     result: List[Dict] = []
-    for assignee_id in ASSIGNED_IDS:
+    # names may come from Bitrix, so they are resolved outside the lock
+    for assignee_id in assignee_ids:
         resolved_name = get_assignee_name_live(assignee_id)
         result.append(
             {
@@ -268,7 +566,7 @@ def get_assignee_name_live(assignee_id: int) -> str:
     name = fallback
     try:
         # Bitrix accepts user.get with FILTER[ID].
-        resp = requests.get(
+        resp = _session.get(
             BITRIX24_USER_GET_URL,
             params={"FILTER[ID]": assignee_id},
             timeout=8
@@ -293,17 +591,35 @@ def get_assignee_name_live(assignee_id: int) -> str:
 
 # ===================== utils ======================
 
-def normalize_phone(raw: str) -> str:
+_PHONE_STRIP_RE = re.compile(r"[^\d+]")
+_BUDGET_RE = re.compile(r"\d[\d _.,]*")
+
+
+@lru_cache(maxsize=4096)
+def _parse_phone(raw: str) -> tuple:
+    # (number, extension): E.164 for valid numbers, otherwise only the digits and "+" the lead typed.
     if not raw:
-        return ""
+        return "", ""
     s = str(raw).strip()
-    m = re.search(r"\d", s)
-    if not m:
-        return s
-    start = m.start()
-    if start > 0 and s[start - 1] == "+":
-        start -= 1
-    return s[start:]
+    try:
+        parsed = phonenumbers.parse(s, PHONE_DEFAULT_REGION)
+        if phonenumbers.is_valid_number(parsed):
+            return phonenumbers.format_number(parsed, phonenumbers.PhoneNumberFormat.E164), parsed.extension or ""
+    except phonenumbers.NumberParseException:
+        pass
+
+    cleaned = _PHONE_STRIP_RE.sub("", s)
+    if not cleaned.lstrip("+"):
+        return s, ""
+    return cleaned, ""
+
+
+def normalize_phone(raw: str) -> str:
+    number, extension = _parse_phone(raw)
+    if extension:
+        # E.164 has no room for an extension, so it follows the number the way phonenumbers prints it
+        return f"{number} ext. {extension}"
+    return number
 
 
 # ================ ROTATION ================
@@ -319,26 +635,28 @@ def _reset_daily_counters_if_new_day() -> None:
 
 def get_next_assigned_id() -> int:
     global ASSIGNED_INDEX
-    _reset_daily_counters_if_new_day()
-    ensure_assigned_integrity()
+    with _rotation_lock:
+        _reset_daily_counters_if_new_day()
+        ensure_assigned_integrity()
 
-    n = len(ASSIGNED_IDS)
-    for _ in range(n):
-        candidate_id = ASSIGNED_IDS[ASSIGNED_INDEX]
-        ASSIGNED_INDEX = (ASSIGNED_INDEX + 1) % n
+        n = len(ASSIGNED_IDS)
+        for _ in range(n):
+            candidate_id = ASSIGNED_IDS[ASSIGNED_INDEX]
+            ASSIGNED_INDEX = (ASSIGNED_INDEX + 1) % n
 
-        limit = DAILY_LIMITS.get(candidate_id)  # None = Р±РµР· Р»РёРјРёС‚Р°
-        count = _assigned_daily_count.get(candidate_id, 0)
-        if limit is None or count < limit:
-            _assigned_daily_count[candidate_id] = count + 1
-            print(f"[Bitrix24] Р’С‹Р±СЂР°РЅ ASSIGNED_BY_ID: {candidate_id} (СЃРµРіРѕРґРЅСЏ: {count + 1})")
-            return candidate_id
+            limit = DAILY_LIMITS.get(candidate_id)  # None = Р±РµР· Р»РёРјРёС‚Р°
+            count = _assigned_daily_count.get(candidate_id, 0)
+            if limit is None or count < limit:
+                _assigned_daily_count[candidate_id] = count + 1
+                print(f"[Bitrix24] Р’С‹Р±СЂР°РЅ ASSIGNED_BY_ID: {candidate_id} (СЃРµРіРѕРґРЅСЏ: {count + 1})")
+                return candidate_id
 
-    return ASSIGNED_IDS[0]  # СЃС‚СЂР°С…РѕРІРєР° РїСЂРё РЅРµРєРѕСЂСЂРµРєС‚РЅРѕР№ РєРѕРЅС„РёРіСѓСЂР°С†РёРё Р»РёРјРёС‚РѕРІ
+        return ASSIGNED_IDS[0]  # СЃС‚СЂР°С…РѕРІРєР° РїСЂРё РЅРµРєРѕСЂСЂРµРєС‚РЅРѕР№ РєРѕРЅС„РёРіСѓСЂР°С†РёРё Р»РёРјРёС‚РѕРІ
 
 
 # ============= BUDGET PARSER =============
 
+@lru_cache(maxsize=2048)
 def parse_budget_to_number(budget_raw: str) -> float:
     """
     Р‘РµСЂС‘Рј РёР· СЃС‚СЂРѕРєРё С‚РѕР»СЊРєРѕ С‡РёСЃР»Рѕ.
@@ -352,7 +670,7 @@ def parse_budget_to_number(budget_raw: str) -> float:
     if not budget_raw:
         return 0.0
     s = str(budget_raw)
-    m = re.search(r"\d[\d _.,]*", s)
+    m = _BUDGET_RE.search(s)
     if not m:
         return 0.0
     num = m.group(0).replace(" ", "").replace("_", "").replace(",", ".")
@@ -364,6 +682,20 @@ def parse_budget_to_number(budget_raw: str) -> float:
 
 # ============= FINANCING MAP =============
 
+_FINANCING_TOKENS: Dict[str, int] = {
+    "cash": 2662, "РЅР°Р»РёС‡": 2662, "РєСЌС€": 2662,
+    "credit": 2664, "РєСЂРµРґРёС‚": 2664, "card": 2664,
+    "schimb": 2666, "РѕР±РјРµРЅ": 2666,
+}
+_FINANCING_TOKENS = {k.lower(): v for k, v in _FINANCING_TOKENS.items()}
+_FINANCING_PRIORITY = (2662, 2664, 2666)
+_FINANCING_RE = re.compile(
+    "|".join(re.escape(k) for k in sorted(_FINANCING_TOKENS, key=len, reverse=True)),
+    re.IGNORECASE,
+)
+
+
+@lru_cache(maxsize=2048)
 def map_financing_to_enum(financing: str):
     """
     2662 вЂ” Cash
@@ -372,114 +704,99 @@ def map_financing_to_enum(financing: str):
     """
     if not financing:
         return None
-    s = financing.lower()
-    if "cash" in s or "РЅР°Р»РёС‡" in s or "РєСЌС€" in s:
-        return 2662
-    if "credit" in s or "РєСЂРµРґРёС‚" in s or "card" in s:
-        return 2664
-    if "schimb" in s or "РѕР±РјРµРЅ" in s:
-        return 2666
+    found = {_FINANCING_TOKENS[m.group(0).lower()] for m in _FINANCING_RE.finditer(financing)}
+    for fin_id in _FINANCING_PRIORITY:
+        if fin_id in found:
+            return fin_id
     return None
 
 
 # ============= CAR PARAMS MAP (РћР‘РќРћР’Р›РЃРќРќРћР•) =============
 
-def map_car_params_to_enums(car_params: str):
-    ids: List[int] = []
-    if not car_params:
-        return ids
-
-    s = car_params.lower()
-
-    if "РЅРµ РІР°Р¶РЅРѕ" in s:
-        ids.append(2724)
-
-    if "С†РµРЅР°" in s or "РµРІСЂРѕ" in s:
-        ids.append(2722)
-
-    if "Р°РІС‚РѕРјР°С‚" in s:
-        ids.append(2698)
-
-    if "РјРµС…Р°РЅРёРє" in s:
-        ids.append(2700)
-
-    if "РїСЂРѕР±РµРі" in s or "km" in s or "РєРј" in s:
-        ids.append(2702)
-
+_CAR_TOKENS: Dict[str, int] = {
+    "РЅРµ РІР°Р¶РЅРѕ": 2724,
+    "С†РµРЅР°": 2722, "РµРІСЂРѕ": 2722,
+    "Р°РІС‚РѕРјР°С‚": 2698,
+    "РјРµС…Р°РЅРёРє": 2700,
+    "РїСЂРѕР±РµРі": 2702, "km": 2702, "РєРј": 2702,
     # вЂ”вЂ”вЂ” РќРћР’Р«Р• Р—РќРђР§Р•РќРРЇ вЂ”вЂ”вЂ”
-    if "7 Р»РµС‚" in s or "7Р»РµС‚" in s:
-        ids.append(2704)
+    "7 Р»РµС‚": 2704, "7Р»РµС‚": 2704,
+    "15 Р»РµС‚": 2706, "15Р»РµС‚": 2706,
+    "Р±РµРЅР·РёРЅ": 2708,
+    "РґРёР·РµР»": 2710,
+    "РїРµСЂРµРґРЅРёР№": 2712,
+    "РїРѕР»РЅС‹Р№": 2714,
+    "Р±РµР· РґС‚Рї": 2716, "СЃРµСЂСЊРµР·РЅС‹С… РґС‚Рї": 2716,
+    "РЅРµ СЃРєСЂСѓС‡РµРЅ": 2718,
+    "РѕРґРёРЅ РІР»Р°РґРµР»СЊ": 2720,
+}
+_CAR_TOKENS = {k.lower(): v for k, v in _CAR_TOKENS.items()}
+# Longest tokens first so a shorter alias never shadows a longer one at the same position.
+_CAR_RE = re.compile(
+    "|".join(re.escape(k) for k in sorted(_CAR_TOKENS, key=len, reverse=True)),
+    re.IGNORECASE,
+)
 
-    if "15 Р»РµС‚" in s or "15Р»РµС‚" in s:
-        ids.append(2706)
 
-    if "Р±РµРЅР·РёРЅ" in s:
-        ids.append(2708)
+@lru_cache(maxsize=2048)
+def _map_car_params_cached(car_params: str) -> tuple:
+    # dict.fromkeys keeps first-seen order and drops duplicates in one pass
+    return tuple(dict.fromkeys(_CAR_TOKENS[m.group(0).lower()] for m in _CAR_RE.finditer(car_params)))
 
-    if "РґРёР·РµР»" in s:
-        ids.append(2710)
 
-    if "РїРµСЂРµРґРЅРёР№" in s:
-        ids.append(2712)
+def map_car_params_to_enums(car_params: str):
+    if not car_params:
+        return []
+    return list(_map_car_params_cached(car_params))
 
-    if "РїРѕР»РЅС‹Р№" in s:
-        ids.append(2714)
 
-    if "Р±РµР· РґС‚Рї" in s or "СЃРµСЂСЊРµР·РЅС‹С… РґС‚Рї" in s:
-        ids.append(2716)
+# ============== DUMMY FILTER ==============
 
-    if "РЅРµ СЃРєСЂСѓС‡РµРЅ" in s:
-        ids.append(2718)
+_DUMMY_RE = re.compile("dummy", re.IGNORECASE)
 
-    if "РѕРґРёРЅ РІР»Р°РґРµР»СЊ" in s:
-        ids.append(2720)
 
-    # СѓРґР°Р»СЏРµРј РґСѓР±Р»РёРєР°С‚С‹
-    res = []
-    seen = set()
-    for i in ids:
-        if i not in seen:
-            seen.add(i)
-            res.append(i)
+def is_dummy_row(row: Dict) -> bool:
+    for key, value in row.items():
+        if _DUMMY_RE.search(str(key)) or _DUMMY_RE.search(str(value)):
+            return True
+    return False
 
-    return res
 
+# ============= Extract fields ==============
 
-# ============== DUMMY FILTER ==============
+_FIELD_ALIASES: Dict[str, tuple] = {
+    "full_name": ("full_name", "РїРѕР»РЅРѕРµ РёРјСЏ", "Name"),
+    "phone": ("phone_number", "РЅСЂ. С‚РµР»:", "Phone"),
+    "email": ("email", "Email"),
+    "car_params": ("РџР°СЂР°РјРµС‚СЂС‹ Р°РІС‚Рѕ",),
+    "financing": ("СЃРїРѕСЃРѕР± РѕС„РѕСЂРјР»РµРЅРёСЏ",),
+    "contact_method": ("СЃРїРѕСЃРѕР± СЃРІСЏР·Рё",),
+    "budget_raw": ("Р±СЋРґР¶РµС‚ РІ в‚¬",),
+    "city": ("РіРѕСЂРѕРґ",),
+}
 
-def is_dummy_row(row: Dict) -> bool:
-    try:
-        text = json.dumps(row, ensure_ascii=False).lower()
-    except Exception:
-        text = str(row).lower()
-    return "dummy" in text
 
+def _first(row: Dict, keys: tuple):
+    for key in keys:
+        value = row.get(key)
+        if value:
+            return value
+    return ""
 
-# ============= Extract fields ==============
 
-def extract_contact_fields_from_row(row: Dict) -> Dict:
-    full_name = (
-            row.get("full_name")
-            or row.get("РїРѕР»РЅРѕРµ РёРјСЏ")
-            or row.get("Name")
-            or ""
-    )
+def _extract_contact_fields(row: Dict) -> Dict:
+    full_name = _first(row, _FIELD_ALIASES["full_name"])
 
-    raw_phone = (
-            row.get("phone_number")
-            or row.get("РЅСЂ. С‚РµР»:")
-            or row.get("Phone")
-            or ""
-    )
+    raw_phone = _first(row, _FIELD_ALIASES["phone"])
     phone = normalize_phone(raw_phone)
 
-    email = (row.get("email") or row.get("Email") or "").strip()
+    email = _first(row, _FIELD_ALIASES["email"]).strip()
 
-    car_params = row.get("РџР°СЂР°РјРµС‚СЂС‹ Р°РІС‚Рѕ") or ""
-    financing = row.get("СЃРїРѕСЃРѕР± РѕС„РѕСЂРјР»РµРЅРёСЏ") or ""
-    contact_method = row.get("СЃРїРѕСЃРѕР± СЃРІСЏР·Рё") or ""
-    budget_raw = row.get("Р±СЋРґР¶РµС‚ РІ в‚¬") or ""
-    city = row.get("РіРѕСЂРѕРґ") or ""
+    car_params = _first(row, _FIELD_ALIASES["car_params"])
+    financing = _first(row, _FIELD_ALIASES["financing"])
+    contact_method = _first(row, _FIELD_ALIASES["contact_method"])
+    budget_raw = _first(row, _FIELD_ALIASES["budget_raw"])
+    city = _first(row, _FIELD_ALIASES["city"])
 
     # РёРјСЏ
     first_name = full_name.strip()
@@ -506,40 +823,46 @@ def extract_contact_fields_from_row(row: Dict) -> Dict:
     }
 
 
-# =============== BITRIX CONTACT ===============
+@lru_cache(maxsize=2048)
+def _extract_contact_fields_cached(row_items: frozenset) -> Dict:
+    return _extract_contact_fields(dict(row_items))
 
-def create_contact_in_bitrix24(first_name, last_name, phone, email, assigned_id: int) -> int | None:
-    if not (first_name or last_name or phone or email):
-        print("[Bitrix24] вњ— РџСѓСЃС‚РѕР№ РєРѕРЅС‚Р°РєС‚ вЂ” РЅРµ СЃРѕР·РґР°С‘Рј")
-        return None
 
-    data = {"fields": {"NAME": first_name, "LAST_NAME": last_name, "ASSIGNED_BY_ID": assigned_id}}
+def extract_contact_fields_from_row(row: Dict) -> Dict:
+    # __id is unique per history entry and does not affect the extracted fields
+    try:
+        key = frozenset((k, v) for k, v in row.items() if k != "__id")
+    except TypeError:
+        return _extract_contact_fields(row)
+    return dict(_extract_contact_fields_cached(key))
+
+
+# =============== BITRIX CONTACT ===============
+
+@lru_cache(maxsize=2048)
+def _build_contact_fields_cached(first_name, last_name, phone, email) -> Dict:
+    contact_fields = {"NAME": first_name, "LAST_NAME": last_name}
 
     if phone:
-        data["fields"]["PHONE"] = [{"VALUE": phone, "VALUE_TYPE": "WORK"}]
+        contact_fields["PHONE"] = [{"VALUE": phone, "VALUE_TYPE": "WORK"}]
     if email:
-        data["fields"]["EMAIL"] = [{"VALUE": email, "VALUE_TYPE": "WORK"}]
+        contact_fields["EMAIL"] = [{"VALUE": email, "VALUE_TYPE": "WORK"}]
 
-    try:
-        resp = requests.post(
-            BITRIX24_CONTACT_ADD_URL,
-            json=data,
-            headers={"Content-Type": "application/json"},
-            timeout=10
-        )
-        print("[Bitrix24] CONTACT:", resp.status_code, resp.text[:300])
-        if resp.status_code == 200:
-            return resp.json().get("result")
-    except Exception as e:
-        print("РћС€РёР±РєР° РєРѕРЅС‚Р°РєС‚Р°:", e)
+    return contact_fields
 
-    return None
+
+def _build_contact_payload(first_name, last_name, phone, email, assigned_id: int) -> Dict:
+    # Same split as leads: the cached part never depends on the rotating assignee.
+    contact_fields = dict(_build_contact_fields_cached(first_name, last_name, phone, email))
+    contact_fields["ASSIGNED_BY_ID"] = assigned_id
+    return {"fields": contact_fields}
 
 
 # =============== BITRIX LEAD ===============
 
-def create_lead_in_bitrix24(contact_id: int | None, fields: Dict, assigned_id: int):
-    global LAST_BITRIX_DEBUG
+@lru_cache(maxsize=2048)
+def _build_lead_fields_cached(field_items: frozenset) -> Dict:
+    fields = dict(field_items)
 
     first_name = fields["first_name"]
     last_name = fields["last_name"]
@@ -556,7 +879,6 @@ def create_lead_in_bitrix24(contact_id: int | None, fields: Dict, assigned_id: i
         "NAME": first_name,
         "LAST_NAME": last_name,
         "SOURCE_ID": BITRIX_SOURCE_ID,
-        "ASSIGNED_BY_ID": assigned_id,
     }
 
     if phone:
@@ -583,61 +905,176 @@ def create_lead_in_bitrix24(contact_id: int | None, fields: Dict, assigned_id: i
     lead_fields["OPPORTUNITY"] = budget
     lead_fields["CURRENCY_ID"] = "EUR"
 
-    if contact_id:
-        lead_fields["CONTACT_ID"] = contact_id
+    return lead_fields
+
+
+def _build_lead_payload(fields: Dict, assigned_id: int) -> Dict:
+    # The parsed part is cached per unique row, retries only add the assignee.
+    lead_fields = dict(_build_lead_fields_cached(frozenset(fields.items())))
+    lead_fields["ASSIGNED_BY_ID"] = assigned_id
+    return {"fields": lead_fields}
+
+
+def _bitrix_query_pairs(prefix: str, value: Any, pairs: List) -> None:
+    if isinstance(value, dict):
+        for key, item in value.items():
+            _bitrix_query_pairs(f"{prefix}[{key}]", item, pairs)
+    elif isinstance(value, (list, tuple)):
+        for i, item in enumerate(value):
+            _bitrix_query_pairs(f"{prefix}[{i}]", item, pairs)
+    else:
+        pairs.append((prefix, "" if value is None else value))
 
-    payload = {"fields": lead_fields}
+
+def _bitrix_command(method: str, params: Dict) -> str:
+    pairs: List = []
+    for key, value in params.items():
+        _bitrix_query_pairs(key, value, pairs)
+    return f"{method}?{urlencode(pairs)}"
+
+
+# =============== BITRIX BATCH ===============
+
+def _post_bitrix_batch(cmd: Dict[str, str], debug: Optional[Dict] = None):
+    # (results, errors) of the batch, or None when the HTTP call itself failed.
+    # Rows are sent from several threads, so the caller's own record goes into `debug`;
+    # LAST_BITRIX_DEBUG only keeps whichever call finished last.
+    global LAST_BITRIX_DEBUG
+
+    payload = {"halt": 0, "cmd": cmd}
 
     try:
-        resp = requests.post(
-            BITRIX24_LEAD_ADD_URL,
+        resp = _session.post(
+            BITRIX24_BATCH_URL,
             json=payload,
             headers={"Content-Type": "application/json"},
             timeout=10
         )
 
-        LAST_BITRIX_DEBUG = {
+        record = {
             "request_payload": payload,
             "response_text": resp.text,
             "status_code": resp.status_code
         }
+        LAST_BITRIX_DEBUG = record
+        if debug is not None:
+            debug.clear()
+            debug.update(record)
 
-        print("[Bitrix24] LEAD:", resp.status_code, resp.text[:300])
+        print("[Bitrix24] BATCH:", resp.status_code, resp.text[:300])
 
         if resp.status_code == 200:
-            return resp.json().get("result")
+            batch = resp.json().get("result") or {}
+            errors = batch.get("result_error") or {}
+            if errors:
+                print("[Bitrix24] BATCH errors:", errors)
+            results = batch.get("result") or {}
+            if not isinstance(results, dict):
+                results = {}
+            if not isinstance(errors, dict):
+                errors = {}
+            return results, errors
 
     except Exception as e:
         LAST_BITRIX_DEBUG = {"exception": str(e)}
+        if debug is not None:
+            debug.clear()
+            debug.update(LAST_BITRIX_DEBUG)
 
     return None
 
 
+def create_contact_and_lead_in_bitrix24(fields: Dict, assigned_id: int, debug: Optional[Dict] = None):
+    first_name = fields["first_name"]
+    last_name = fields["last_name"]
+    phone = fields["phone"]
+    email = fields["email"]
+
+    # contact + lead in one round-trip; the lead picks up the new contact id via $result[contact]
+    cmd: Dict[str, str] = {}
+    lead_cmd = _bitrix_command("crm.lead.add", _build_lead_payload(fields, assigned_id))
+    if first_name or last_name or phone or email:
+        contact_payload = _build_contact_payload(first_name, last_name, phone, email, assigned_id)
+        cmd["contact"] = _bitrix_command("crm.contact.add", contact_payload)
+        # the reference must stay unencoded for Bitrix to substitute it
+        cmd["lead"] = lead_cmd + "&fields[CONTACT_ID]=$result[contact]"
+    else:
+        print("[Bitrix24] вњ— РџСѓСЃС‚РѕР№ РєРѕРЅС‚Р°РєС‚ вЂ” РЅРµ СЃРѕР·РґР°С‘Рј")
+        cmd["lead"] = lead_cmd
+
+    outcome = _post_bitrix_batch(cmd, debug)
+    if outcome is None:
+        return None
+    results, errors = outcome
+
+    if not results.get("lead") and "contact" in errors:
+        # The contact failed, so $result[contact] never resolved: still create the lead, without a contact.
+        print("[Bitrix24] Contact failed, re-sending lead without contact")
+        outcome = _post_bitrix_batch({"lead": lead_cmd}, debug)
+        if outcome is None:
+            return None
+        results, _ = outcome
+
+    return results.get("lead")
+
+
 # =============== SEND ONE LEAD ===============
 
-def send_lead_row_to_bitrix24(row: Dict) -> None:
+def send_lead_row_to_bitrix24(row: Dict, assigned_id: int | None = None) -> Dict:
+    # Returns this row's own Bitrix request/response record.
     if is_dummy_row(row):
         print("[Bitrix24] Dummy вЂ” РїСЂРѕРїСѓСЃРєР°РµРј")
-        return
+        return {"msg": "dummy row, not sent"}
 
     fields = extract_contact_fields_from_row(row)
 
-    assigned_id = get_next_assigned_id()
+    if assigned_id is None:
+        assigned_id = pick_assigned_id()
 
-    contact_id = create_contact_in_bitrix24(
-        fields["first_name"],
-        fields["last_name"],
-        fields["phone"],
-        fields["email"],
-        assigned_id
-    )
-
-    lead_id = create_lead_in_bitrix24(contact_id, fields, assigned_id)
+    debug: Dict = {}
+    lead_id = create_contact_and_lead_in_bitrix24(fields, assigned_id, debug)
 
     if lead_id:
         print(f"[Bitrix24] Р›РёРґ СЃРѕР·РґР°РЅ {lead_id}")
     else:
         print("[Bitrix24] Р›РёРґ РќР• СЃРѕР·РґР°РЅ")
+    return debug
+
+
+def pick_assigned_id() -> int:
+    # The rows are already recorded as sent, so a rotation error must not stop them from being posted.
+    try:
+        return get_next_assigned_id()
+    except Exception as e:
+        fallback = (ASSIGNED_IDS or DEFAULT_ASSIGNED_IDS)[0]
+        print(f"[WARN] Rotation failed ({e}), assigning to {fallback}")
+        return fallback
+
+
+def send_lead_rows_to_bitrix24(rows: List[Dict]) -> None:
+    if not rows:
+        return
+    if len(rows) == 1:
+        try:
+            send_lead_row_to_bitrix24(rows[0])
+        except Exception as e:
+            print(f"[Bitrix24] Send failed: {e}")
+        return
+
+    # Rotation is stateful, so assignees are picked in sheet order before the fan-out.
+    jobs = []
+    for row in rows:
+        if is_dummy_row(row):
+            send_lead_row_to_bitrix24(row)
+            continue
+        jobs.append((row, pick_assigned_id()))
+
+    futures = [_bitrix_executor.submit(send_lead_row_to_bitrix24, row, assigned_id) for row, assigned_id in jobs]
+    for future in futures:
+        try:
+            future.result()
+        except Exception as e:
+            print(f"[Bitrix24] Send failed: {e}")
 
 
 # ================== NEW LEADS ==================
@@ -647,48 +1084,189 @@ def fetch_new_leads() -> List[Dict]:
     if not rows:
         return []
 
-    last_idx = get_last_row_index()
-    cur_last = len(rows) - 1
+    # Rows are matched by lead identity hash, so deleted or reordered sheet rows no longer
+    # re-send or skip leads the way a stored row index did. Counts ignore row order, so
+    # sorting the sheet sends nothing.
+    global _sent_needs_seed, _repeated_id_rows
+    with _history_lock:
+        keys: List[tuple] = []
+        for row in rows:
+            identity = row_identity(row)
+            keys.append((_hash_identity(identity), identity[0] == "contact"))
+        last_idx = get_last_row_index()
+
+        sent = load_sent_hashes()
+        if _sent_needs_seed:
+            # First run: everything up to the row index watermark counts as sent.
+            # A fresh install has no watermark: every row counts as sent, and the last one
+            # is shown in history as before, without posting a possibly weeks-old lead to Bitrix.
+            if last_idx != -1:
+                mark_rows_sent([h for h, _ in keys[:last_idx + 1]])
+            else:
+                mark_rows_sent([h for h, _ in keys])
+                if not load_history():
+                    append_to_history([rows[-1]])
+            _sent_needs_seed = False
+
+        # The n-th row with a contact identity is sent once n of them have been; a lead id only once.
+        occurrence: "Counter[str]" = Counter()
+        pending: List[tuple] = []
+        repeated = 0
+        for (h, is_contact), row in zip(keys, rows):
+            occurrence[h] += 1
+            if is_contact:
+                is_new = occurrence[h] > sent[h]
+            else:
+                is_new = occurrence[h] == 1 and not sent[h]
+                repeated += occurrence[h] > 1
+            if is_new:
+                pending.append((h, row))
+        if repeated > _repeated_id_rows:
+            print(f"[INFO] {repeated} sheet rows repeat an already listed lead id, not sent again")
+        _repeated_id_rows = repeated
+
+        new_rows = [row for _, row in pending]
+        mark_rows_sent([h for h, _ in pending])
+
+        # Contact counts follow the rows still in the sheet, so a person whose row was deleted
+        # is sent again when they submit the form again. A deletion and a new submission of the
+        # same contact between two polls leave the counts unchanged, so that one submission is not sent.
+        _contact_hashes.update(h for h, is_contact in keys if is_contact)
+        stale = {h: occurrence[h] for h in _contact_hashes if sent[h] > occurrence[h]}
+        if stale:
+            for h, count in stale.items():
+                if count:
+                    sent[h] = count
+                else:
+                    del sent[h]
+            print(f"[INFO] {len(stale)} sent contact(s) lost rows from the sheet, their next submission is sent again")
+            _rewrite_sent_hashes()
+
+        set_last_row_index(len(rows) - 1)
+        new_rows = append_to_history(new_rows)
+
+    send_lead_rows_to_bitrix24(new_rows)
 
-    if last_idx == -1:
-        new_rows = [rows[-1]]
-    else:
-        new_rows = rows[last_idx + 1:] if cur_last > last_idx else []
+    return new_rows
 
-    set_last_row_index(cur_last)
-    new_rows = append_to_history(new_rows)
 
-    for row in new_rows:
-        send_lead_row_to_bitrix24(row)
+def drain_new_leads() -> List[Dict]:
+    cutoff = time.time() - NEW_LEADS_TTL_SECONDS
+    with _new_leads_lock:
+        drained = [lead for ts, lead in _new_leads_buffer if ts >= cutoff]
+        _new_leads_buffer.clear()
+    return drained
 
-    return new_rows
+
+def _poll_loop() -> None:
+    while True:
+        try:
+            load_sheet_rows(force=True)
+            new_leads = fetch_new_leads()
+            if new_leads:
+                now = time.time()
+                with _new_leads_lock:
+                    _new_leads_buffer.extend((now, lead) for lead in new_leads)
+        except Exception as e:
+            print(f"[WARN] Sheet poll failed: {e}")
+        if not _first_poll_done.is_set():
+            # this run just read the sheet: wakeups requested while it ran are already served
+            _poll_wakeup.clear()
+            _first_poll_done.set()
+        _poll_wakeup.wait(REFRESH_INTERVAL_SECONDS)
+        _poll_wakeup.clear()
+
+
+def _lock_poller() -> bool:
+    # Guards against a second process (e.g. a stray `python app.py` next to gunicorn) sending
+    # every lead twice. It does not make workers > 1 safe: history and the new-leads buffer are per-process.
+    # Called with _poller_start_lock held.
+    global _poller_lock_fd, _poller_retry_at
+    if time.time() < _poller_retry_at:
+        return False
+    fd = os.open(POLLER_LOCK_FILE, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        os.close(fd)
+        if not _poller_retry_at:
+            print(f"[WARN] Sheet poller already running in another process, pid {os.getpid()} does not poll")
+        # retried from later requests, so this process takes over if the owner exits
+        _poller_retry_at = time.time() + REFRESH_INTERVAL_SECONDS
+        return False
+    _poller_lock_fd = fd
+    return True
+
+
+def start_background_poller() -> None:
+    global _poller_started
+    with _poller_start_lock:
+        if _poller_started or not _lock_poller():
+            return
+        _poller_started = True
+
+    threading.Thread(target=_poll_loop, name="sheet-poller", daemon=True).start()
+
+
+def claim_request_polling() -> bool:
+    # Without START_SHEET_POLLER no thread polls, so the page's /api/leads/new requests fetch
+    # the sheet as they did before the poller existed.
+    global _request_polling
+    with _poller_start_lock:
+        if not _request_polling and _lock_poller():
+            _request_polling = True
+            print(
+                "[WARN] START_SHEET_POLLER is not set, no background sheet poller runs: "
+                "leads reach Bitrix only while a page polls /api/leads/new"
+            )
+    return _request_polling
+
+
+@app.before_request
+def ensure_background_poller() -> None:
+    # Only serving processes opt in: gunicorn.conf.py and `python app.py` set START_SHEET_POLLER,
+    # other servers (flask run, waitress, uwsgi) via the START_SHEET_POLLER=1 env var. Test clients
+    # and scripts importing app never start the poller; without it, /api/leads/new fetches the
+    # sheet itself, as the page polled it before the poller existed. Requests keep retrying while another
+    # process holds the poller lock, so this one takes over if that process exits.
+    if app.config["START_SHEET_POLLER"] and not _poller_started:
+        start_background_poller()
 
 
 # ====================== ROUTES ======================
 
-@app.route("/")
-def index():
-    history = load_history()
+def stream_json_array(items: List[Dict]) -> Response:
+    # Serialize one lead at a time so the full JSON body is never held in memory.
+    # Keys are sorted like jsonify's: the page builds its table columns from the first lead's keys.
+    def generate():
+        yield "["
+        for i, item in enumerate(items):
+            yield ("," if i else "") + json_dumps(item, option=orjson.OPT_SORT_KEYS).decode("utf-8")
+        yield "]"
 
-    if not history:
-        rows = load_sheet_rows()
-        if rows:
-            last = rows[-1]
-            save_history([last])
-            set_last_row_index(len(rows) - 1)
-            history = [last]
+    return Response(stream_with_context(generate()), mimetype="application/json")
 
-    return render_template("index.html", leads=history)
+
+@app.route("/")
+def index():
+    if not _first_poll_done.is_set() and not load_history():
+        # nothing recorded yet: let the poller pick up the sheet now instead of blocking the page.
+        # Only before its first run, so an emptied history does not force a sheet fetch per page view.
+        _poll_wakeup.set()
+    # the page loads its leads through /api/leads/last and polling, not from the template
+    return render_template("index.html")
 
 
 @app.route("/api/leads/new")
 def api_new_leads():
-    return jsonify(fetch_new_leads())
+    if not _poller_started and not app.config["START_SHEET_POLLER"] and claim_request_polling():
+        return stream_json_array(fetch_new_leads())
+    return stream_json_array(drain_new_leads())
 
 
 @app.route("/api/leads")
 def api_leads():
-    return jsonify(load_history_with_ids())
+    return stream_json_array(list(load_history_with_ids()))
 
 
 @app.route("/api/leads", methods=["POST"])
@@ -711,7 +1289,7 @@ def api_leads_delete(lead_id: str):
 
 @app.route("/api/leads/last")
 def api_last():
-    rows = load_sheet_rows()
+    rows = get_sheet_rows()
     return jsonify(rows[-1] if rows else {})
 
 
@@ -722,16 +1300,15 @@ def api_dbg():
 
 @app.route("/api/test/send_last_to_bitrix")
 def api_test():
-    rows = load_sheet_rows()
+    rows = get_sheet_rows()
     if not rows:
         return jsonify({"error": "РќРµС‚ СЃС‚СЂРѕРє"})
-    send_lead_row_to_bitrix24(rows[-1])
-    return jsonify(LAST_BITRIX_DEBUG)
+    return jsonify(send_lead_row_to_bitrix24(rows[-1]))
 
 
 @app.route("/api/test/send_row_to_bitrix")
 def api_test_send_row():
-    rows = load_sheet_rows()
+    rows = get_sheet_rows()
     if not rows:
         return jsonify({"error": "No rows in Google Sheet"}), 404
 
@@ -752,12 +1329,12 @@ def api_test_send_row():
             }
         ), 404
 
-    send_lead_row_to_bitrix24(rows[row_index])
+    debug = send_lead_row_to_bitrix24(rows[row_index])
     return jsonify(
         {
             "requested_row": row_number,
             "row_index_in_data": row_index,
-            "bitrix_debug": LAST_BITRIX_DEBUG,
+            "bitrix_debug": debug,
         }
     )
 
@@ -779,10 +1356,6 @@ def api_assignees_add():
     except Exception:
         return jsonify({"error": "id is required and must be integer"}), 400
 
-    ensure_assigned_integrity()
-    if assignee_id in ASSIGNED_IDS:
-        return jsonify({"error": "id already exists"}), 409
-
     try:
         limit = parse_limit(payload.get("limit"))
     except ValueError as e:
@@ -790,25 +1363,32 @@ def api_assignees_add():
 
     name = str(payload.get("name") or "").strip()
 
-    ASSIGNED_IDS.append(assignee_id)
-    ASSIGNED_INDEX %= len(ASSIGNED_IDS)
+    # the poller rotates through the same lists concurrently
+    with _rotation_lock:
+        ensure_assigned_integrity()
+        if assignee_id in ASSIGNED_IDS:
+            return jsonify({"error": "id already exists"}), 409
 
-    if limit is None:
-        DAILY_LIMITS.pop(assignee_id, None)
-    else:
-        DAILY_LIMITS[assignee_id] = limit
-    ASSIGNEE_NAMES[assignee_id] = name
-    _assignee_name_cache.pop(assignee_id, None)
+        ASSIGNED_IDS.append(assignee_id)
+        ASSIGNED_INDEX %= len(ASSIGNED_IDS)
 
-    save_assigned_config()
+        if limit is None:
+            DAILY_LIMITS.pop(assignee_id, None)
+        else:
+            DAILY_LIMITS[assignee_id] = limit
+        ASSIGNEE_NAMES[assignee_id] = name
+        _assignee_name_cache.pop(assignee_id, None)
+
+        save_assigned_config()
     return jsonify({"items": get_assignees_snapshot()}), 201
 
 
 @app.route("/api/assignees/<int:assignee_id>", methods=["PUT"])
 def api_assignees_update(assignee_id: int):
-    ensure_assigned_integrity()
-    if assignee_id not in ASSIGNED_IDS:
-        return jsonify({"error": "id not found"}), 404
+    with _rotation_lock:
+        ensure_assigned_integrity()
+        if assignee_id not in ASSIGNED_IDS:
+            return jsonify({"error": "id not found"}), 404
 
     payload = request.get_json(silent=True)
     if not isinstance(payload, dict):
@@ -818,47 +1398,59 @@ def api_assignees_update(assignee_id: int):
         limit = parse_limit(payload.get("limit"))
     except ValueError as e:
         return jsonify({"error": str(e)}), 400
-    name = ASSIGNEE_NAMES.get(assignee_id, "")
-    if "name" in payload:
-        name = str(payload.get("name") or "").strip()
 
-    if limit is None:
-        DAILY_LIMITS.pop(assignee_id, None)
-    else:
-        DAILY_LIMITS[assignee_id] = limit
-    ASSIGNEE_NAMES[assignee_id] = name
-    _assignee_name_cache.pop(assignee_id, None)
+    with _rotation_lock:
+        # removed by a concurrent DELETE in the meantime
+        if assignee_id not in ASSIGNED_IDS:
+            return jsonify({"error": "id not found"}), 404
+        name = ASSIGNEE_NAMES.get(assignee_id, "")
+        if "name" in payload:
+            name = str(payload.get("name") or "").strip()
+
+        if limit is None:
+            DAILY_LIMITS.pop(assignee_id, None)
+        else:
+            DAILY_LIMITS[assignee_id] = limit
+        ASSIGNEE_NAMES[assignee_id] = name
+        _assignee_name_cache.pop(assignee_id, None)
 
-    save_assigned_config()
+        save_assigned_config()
     return jsonify({"items": get_assignees_snapshot()})
 
 
 @app.route("/api/assignees/<int:assignee_id>", methods=["DELETE"])
 def api_assignees_delete(assignee_id: int):
     global ASSIGNED_INDEX
-    ensure_assigned_integrity()
-    if assignee_id not in ASSIGNED_IDS:
-        return jsonify({"error": "id not found"}), 404
-    if len(ASSIGNED_IDS) <= 1:
-        return jsonify({"error": "at least one assignee must remain"}), 400
-
-    removed_index = ASSIGNED_IDS.index(assignee_id)
-    ASSIGNED_IDS.remove(assignee_id)
-    DAILY_LIMITS.pop(assignee_id, None)
-    ASSIGNEE_NAMES.pop(assignee_id, None)
-    _assignee_name_cache.pop(assignee_id, None)
-    _assigned_daily_count.pop(assignee_id, None)
-
-    if ASSIGNED_INDEX > removed_index:
-        ASSIGNED_INDEX -= 1
-    ensure_assigned_integrity()
+    with _rotation_lock:
+        ensure_assigned_integrity()
+        if assignee_id not in ASSIGNED_IDS:
+            return jsonify({"error": "id not found"}), 404
+        if len(ASSIGNED_IDS) <= 1:
+            return jsonify({"error": "at least one assignee must remain"}), 400
+
+        removed_index = ASSIGNED_IDS.index(assignee_id)
+        ASSIGNED_IDS.remove(assignee_id)
+        DAILY_LIMITS.pop(assignee_id, None)
+        ASSIGNEE_NAMES.pop(assignee_id, None)
+        _assignee_name_cache.pop(assignee_id, None)
+        _assigned_daily_count.pop(assignee_id, None)
 
-    save_assigned_config()
+        if ASSIGNED_INDEX > removed_index:
+            ASSIGNED_INDEX -= 1
+        ensure_assigned_integrity()
+
+        save_assigned_config()
     return jsonify({"items": get_assignees_snapshot()})
 
 
 load_assigned_config()
+load_history()
+load_sent_hashes()
+threading.Thread(target=_state_writer_loop, name="state-writer", daemon=True).start()
 
 
 if __name__ == "__main__":
+    # The poller sends leads to Bitrix, so it only starts in a serving process, never on a bare `import app`.
+    app.config["START_SHEET_POLLER"] = True
+    start_background_poller()
     app.run(host="0.0.0.0", port=8282, debug=False, use_reloader=False)
@@ -0,0 +1,25 @@
+# Production server: gunicorn -c gunicorn.conf.py app:app
+#
+# Lead history, the /api/leads/new buffer and rotation counters live in process memory,
+# so workers MUST stay 1: a second worker would serve stale /api/leads and an
+# /api/leads/new that never fills. Concurrency comes from threads instead, so a slow
+# Bitrix call in /api/test/* no longer blocks /api/leads/last.
+
+bind = "0.0.0.0:8282"
+worker_class = "gthread"
+workers = 1
+threads = 8
+timeout = 60
+
+
+def on_starting(server):
+    if server.cfg.workers != 1:
+        raise RuntimeError("app keeps lead state in process memory: run gunicorn with workers = 1")
+
+
+def post_worker_init(worker):
+    # The poller sends leads to Bitrix, so it only runs in a serving process, never on a bare `import app`.
+    from app import app, start_background_poller
+
+    app.config["START_SHEET_POLLER"] = True
+    start_background_poller()